@@ -1,8 +1,17 @@
-import subprocess
-import json
 import time
 import os
+import re
+import select
+import ctypes
 import requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from middlewared.client import Client, ClientException
+
+
+# Matches KEY=value lines, with optionally quoted values. Comments are only supported on their own line.
+_ENV_RE = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*'
+                     r'(?:"([^\r\n]*)"|\'([^\r\n]*)\'|([^\r\n]*?))[ \t\r]*$', re.M)
 
 
 def load_dotenv():
@@ -10,86 +19,184 @@ def load_dotenv():
 
     if os.path.exists(dotenv_path):
         with open(dotenv_path, 'r') as file:
-            for line in file:
-                # Strip leading/trailing whitespace and ignore empty lines or comments
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    # Split at the first '=' and strip any extra whitespace
-                    key, value = line.split('=', 1)
-                    key = key.strip()
-                    value = value.strip()
-
-                    # Remove surrounding quotes from value if they exist
-                    if value.startswith('"') and value.endswith('"'):
-                        value = value[1:-1]
-                    elif value.startswith('\'') and value.endswith('\''):
-                        value = value[1:-1]
-
-                    # Set the environment variable
-                    os.environ[key] = value
+            contents = file.read()
+
+        os.environ.update({
+            match[1]: next(value for value in match.groups()[1:] if value is not None)
+            for match in _ENV_RE.finditer(contents)
+        })
     else:
         raise FileNotFoundError(f'No .env file found in the script directory.')
 
 
+def _parse_bool(value):
+    if value.lower() in ('1', 'true', 'yes'):
+        return True
+    if value.lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f'{value!r} is not a boolean')
+
+
+def _env(name, default=None, cast=str, required=False):
+    # Empty values (e.g. 'DISCORD_WEBHOOK_URL=') are treated as not set
+    value = os.environ.get(name)
+    if value is None or value == '':
+        if required:
+            raise ValueError(f'Required environment variable {name} is not set in the .env file.')
+        return default
+
+    try:
+        return cast(value)
+    except ValueError as e:
+        raise ValueError(f'Invalid value for environment variable {name}: {e}') from e
+
+
 load_dotenv()
 
-DISCORD_WEBHOOK_URL = os.getenv('DISCORD_WEBHOOK_URL')
-ZPOOL_NAME = os.getenv('ZPOOL_NAME')
-MIN_EXECUTION_TIME = float(os.getenv('MIN_EXECUTION_TIME', 90.0))
+DISCORD_WEBHOOK_URL = _env('DISCORD_WEBHOOK_URL')
+ZPOOL_NAME = _env('ZPOOL_NAME', required=True)
+MIN_EXECUTION_TIME = _env('MIN_EXECUTION_TIME', 90.0, float)
+PARALLEL_GROUPS = _env('PARALLEL_GROUPS', False, _parse_bool)
 
 print(f'{DISCORD_WEBHOOK_URL=}')
 print(f'{ZPOOL_NAME=}')
 print(f'{MIN_EXECUTION_TIME=}')
+print(f'{PARALLEL_GROUPS=}')
+
+_SESSION = requests.Session()
+
+DISCORD_MESSAGE_LIMIT = 2000
+MAX_ERROR_LENGTH = 150
+MAX_REPORTED_FAILURES = 5
+
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+
+def query_replications(client):
+    # Only select the fields that are actually used, so the middleware doesn't send the full replication configs
+    return client.call('replication.query', [], {'select': ['id', 'name', 'source_datasets', 'target_dataset']})
+
+
+def run_replication(client, replication_id):
+    # job=True blocks until the replication job has finished, and raises a ClientException if it has failed
+    return client.call('replication.run', replication_id, job=True)
+
+
+def datasets_overlap(a, b):
+    # A dataset overlaps with itself and with all of its ancestors and descendants
+    return a == b or a.startswith(b + '/') or b.startswith(a + '/')
+
+
+def group_replications(replications):
+    # Replications touching the same dataset, or a parent/child of it, may contend with each other, so they are kept in the same group.
+    # Groups are merged with a union-find over the replication indices.
+    parents = list(range(len(replications)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    datasets = [[*replication['source_datasets'], replication['target_dataset']] for replication in replications]
+    for index in range(len(replications)):
+        for other_index in range(index):
+            if any(datasets_overlap(a, b) for a in datasets[index] for b in datasets[other_index]):
+                parents[find(index)] = find(other_index)
+
+    groups = defaultdict(list)
+    for index, replication in enumerate(replications):
+        groups[find(index)].append(replication)
 
+    return list(groups.values())
 
-def query_replications():
-    command = ['midclt', 'call', 'replication.query']
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f'{result.stdout=}')
-        print(f'{result.stderr=}')
-        raise Exception(f'Process finished with exit code {result.returncode}.')
 
-    return json.loads(result.stdout)
+def run_replication_group(client, replications):
+    # A failed replication shouldn't prevent the remaining ones from running, so failures are collected and returned
+    failures = []
+    for replication in replications:
+        print(f'Running replication #{replication["id"]} ({replication["name"]})...')
+        try:
+            run_replication(client, replication['id'])
+        except ClientException as e:
+            print(f'Replication #{replication["id"]} ({replication["name"]}) has failed: {e}')
+            failures.append((replication, e))
+        else:
+            print(f'Replication #{replication["id"]} ({replication["name"]}) has finished!')
+
+    return failures
+
+
+def run_replication_group_with_own_client(replications):
+    # The middleware client isn't known to be thread-safe, so every parallel group uses its own connection
+    with Client() as client:
+        return run_replication_group(client, replications)
+
+
+def summarize_error(error):
+    # Replication errors can contain multi-line zfs output and backticks, which would break the Discord formatting
+    lines = str(error).strip().splitlines()
+    summary = lines[0].replace('`', "'") if lines else type(error).__name__
+    if len(summary) > MAX_ERROR_LENGTH:
+        summary = summary[:MAX_ERROR_LENGTH - 3] + '...'
+
+    return summary
+
+
+def get_zpool_usage(client):
+    return client.call('pool.query', [['name', '=', ZPOOL_NAME]], {'get': True})
+
 
+def humanize_bytes(num_bytes):
+    # pool.query returns None for the sizes when the pool is offline or unavailable
+    if num_bytes is None:
+        return 'n/a'
 
-def get_running_replications():
-    return [r for r in query_replications() if r['state']['state'] == 'RUNNING']
+    if num_bytes < 1024:
+        return f'{num_bytes:.0f} B'
 
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        num_bytes /= 1024
+        if num_bytes < 1024:
+            return f'{num_bytes:.1f} {unit}'
 
-def wait_for_running_replications():
-    while len(get_running_replications()) > 0:
-        print('Waiting for replication(s) to finish...')
-        time.sleep(5)
+    num_bytes /= 1024
 
+    return f'{num_bytes:.1f} PiB'
 
-def start_replication(replication_id):
-    command = ['midclt', 'call', 'replication.run', str(replication_id)]
-    result = subprocess.run(command, capture_output=True, text=True)
-    if result.returncode != 0:
-        print(f'{result.stdout=}')
-        print(f'{result.stderr=}')
-        raise Exception(f'Process finished with exit code {result.returncode}.')
 
+def wait_for_file(path, deadline):
+    # Returns as soon as the file exists, or once the deadline has passed.
+    # inotify isn't available on every platform, in which case this simply sleeps until the deadline.
+    inotify_fd = -1
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_CLOEXEC)
+        if inotify_fd >= 0 and libc.inotify_add_watch(inotify_fd, os.path.dirname(path).encode(), IN_CREATE | IN_MOVED_TO) < 0:
+            os.close(inotify_fd)
+            inotify_fd = -1
+    except (OSError, AttributeError):
+        pass
 
-def get_zpool_usage():
-    # Run the 'zpool list' command and capture the output
-    result = subprocess.run(['zpool', 'list'], stdout=subprocess.PIPE, text=True)
+    if inotify_fd < 0:
+        time.sleep(max(0.0, deadline - time.time()))
+        return os.path.exists(path)
 
-    # Parse the output
-    lines = result.stdout.strip().split('\n')
-    headers = lines[0].split()
-    pools = lines[1:]
+    try:
+        while not os.path.exists(path):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
 
-    # Create the dictionary
-    pools_dict = {}
-    for pool in pools:
-        values = pool.split()
-        pool_name = values[0]
-        pool_data = {header.lower(): value for header, value in zip(headers, values)}
-        pools_dict[pool_name] = pool_data
+            readable, _, _ = select.select([inotify_fd], [], [], remaining)
+            if readable:
+                # Drain the events, the file's existence is checked again at the top of the loop
+                os.read(inotify_fd, 4096)
 
-    return pools_dict
+        return True
+    finally:
+        os.close(inotify_fd)
 
 
 def shutdown_system():
@@ -97,60 +204,80 @@ def shutdown_system():
 
 
 def format_time(seconds):
-    hours, remainder = divmod(seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
-
-    time_components = []
-    if hours > 0:
-        time_components.append(f'{hours:.0f} hours')
-    if minutes > 0:
-        time_components.append(f'{minutes:.0f} minutes')
-    if seconds > 0 or not time_components:
-        time_components.append(f'{seconds:.1f} seconds')
-
-    if len(time_components) > 1:
-        return ', '.join(time_components[:-1]) + ' and ' + time_components[-1]
-    else:
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, whole_seconds = divmod(remainder, 60)
+
+    # Only show fractional seconds when the duration is shorter than a minute
+    if hours == 0 and minutes == 0:
+        return f'{seconds:.1f} seconds'
+
+    time_components = [f'{value} {unit}' for value, unit in ((hours, 'hours'), (minutes, 'minutes'), (whole_seconds, 'seconds')) if value]
+    if len(time_components) == 1:
         return time_components[0]
 
+    return ', '.join(time_components[:-1]) + ' and ' + time_components[-1]
+
 
 def send_discord_message(message):
     if DISCORD_WEBHOOK_URL is None:
         return
 
-    requests.post(
-        DISCORD_WEBHOOK_URL,
-        json={
-            'content': message
-        }
-    )
+    # Discord rejects messages that exceed its content limit
+    if len(message) > DISCORD_MESSAGE_LIMIT:
+        message = message[:DISCORD_MESSAGE_LIMIT - 3] + '...'
+
+    try:
+        response = _SESSION.post(
+            DISCORD_WEBHOOK_URL,
+            json={
+                'content': message
+            },
+            timeout=10
+        )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        # A failing webhook shouldn't prevent the system from shutting down
+        print(f'Failed to send Discord message: {e}')
 
 
 def main():
     start = time.time()
 
-    replications = query_replications()
-    print(f'Found {len(replications)} replications.')
-    for replication in replications:
-        print(f'Running replication #{replication["id"]} ({replication["name"]})...')
-        start_replication(replication['id'])
-        wait_for_running_replications()
-        print(f'Replication #{replication["id"]} ({replication["name"]}) has finished!')
+    with Client() as client:
+        replications = query_replications(client)
+        print(f'Found {len(replications)} replications.')
+        if PARALLEL_GROUPS and replications:
+            groups = group_replications(replications)
+            print(f'Running {len(groups)} replication groups in parallel...')
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                futures = [executor.submit(run_replication_group_with_own_client, group) for group in groups]
+                failures = [failure for future in futures for failure in future.result()]
+        else:
+            failures = run_replication_group(client, replications)
 
-    print('All replications have finished.')
+        print('All replications have finished.')
 
-    elapsed = time.time() - start
+        elapsed = time.time() - start
 
-    # Ensure the system is on for at least MIN_EXECUTION_TIME seconds, to allow the creation of the 'no_shutdown' file by the server administrator.
-    time.sleep(max(0.0, MIN_EXECUTION_TIME - elapsed))
+        pool_usage = get_zpool_usage(client)
 
+    if pool_usage['allocated'] is not None and pool_usage['size']:
+        capacity = f'{pool_usage["allocated"] / pool_usage["size"] * 100:.0f}%'
+    else:
+        capacity = 'n/a'
+    discord_message = f'Performed `{len(replications) - len(failures)}/{len(replications)}` replications successfully in `{format_time(elapsed)}`.\n'
+    for replication, error in failures[:MAX_REPORTED_FAILURES]:
+        discord_message += f'Replication `{replication["name"]}` has failed: `{summarize_error(error)}`\n'
+    if len(failures) > MAX_REPORTED_FAILURES:
+        discord_message += f'...and `{len(failures) - MAX_REPORTED_FAILURES}` more failed replications.\n'
+    discord_message += (f'Pool usage: `{capacity}` (`{humanize_bytes(pool_usage["free"])}` free of `{humanize_bytes(pool_usage["size"])}`)\n'
+                        f'Health: `{pool_usage["status"]}`')
+
+    # Ensure the system is on for at least MIN_EXECUTION_TIME seconds, to allow the creation of the 'no_shutdown' file by the server administrator.
+    # The wait ends as soon as the file is created.
     no_shutdown_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'no_shutdown')
-    perform_shutdown = not os.path.exists(no_shutdown_file)
+    perform_shutdown = not wait_for_file(no_shutdown_file, start + MIN_EXECUTION_TIME)
 
-    pool_usage = get_zpool_usage()[ZPOOL_NAME]
-    discord_message = (f'Performed `{len(replications)}` replications in `{format_time(elapsed)}`.\n'
-                       f'Pool usage: `{pool_usage["cap"]}` (`{pool_usage["free"]}` free of `{pool_usage["size"]}`)\n'
-                       f'Health: `{pool_usage["health"]}`')
     if perform_shutdown:
         discord_message += '\n\nShutting down the system now.'
     send_discord_message(discord_message)